@@ -1,104 +1,315 @@
 import streamlit as st
 import fitz  # PyMuPDF
-from PIL import Image
 import ollama
-import io
+import asyncio
+import hashlib
+import json
+import multiprocessing
 import os
-import base64
+import shutil
+import tempfile
 import time
+import uuid
+from collections.abc import Callable
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 from pathlib import Path
 
+import pdf_render
+
 # --- Configuration ---
 OLLAMA_MODEL = "gemma-3-4b-it-gpu:latest"
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+OLLAMA_REQUEST_TIMEOUT_SECONDS = 300.0
 OUTPUT_DIR = "md_docs"
 MAX_PROCESSING_TIME_PER_PAGE_SECONDS = 120  # Add a timeout per page
+MAX_CONCURRENT_FILES = 2  # Overlaps one file's rendering with another's OCR
+MAX_RENDER_WORKERS = 4  # Rendering speedup flattens out beyond ~4 processes
+# Smaller files render faster on one thread than by copying the PDF over for
+# the worker processes to re-open (a page takes ~30 ms at OCR_MAX_DIM)
+RENDER_POOL_MIN_PAGES = 16
+# Max OCR requests in flight; keep in step with the Ollama server's own
+# OLLAMA_NUM_PARALLEL, since extra requests only queue or split its context.
+# The server reads 0 (or unset) as "auto", which falls back to 4 here
+OLLAMA_NUM_PARALLEL = max(0, int(os.getenv("OLLAMA_NUM_PARALLEL") or 0)) or 4
+OCR_PAGES_PER_REQUEST = 4  # Adjacent pages sent together in one multi-image chat
+PAGE_BREAK_SENTINEL = "<<<PAGE_BREAK>>>"  # Separates pages in a batched response
+OCR_MAX_DIM = 1120  # Longest rendered side in px, near the vision model's input size
+# Fixed for every request (including the warm-up); a different num_ctx makes
+# Ollama reload the model. Sized for a full batch of images plus
+# OCR_NUM_PREDICT_PER_PAGE tokens of output per page
+OCR_NUM_CTX = 16384
+OCR_NUM_PREDICT_PER_PAGE = 2048  # Caps decode time if the model runs on or loops
+OCR_PROMPT = "Extract all text content from this image accurately. Preserve the original structure and formatting as much as possible in Markdown format."
+OCR_BATCH_PROMPT = (  # Formatted with the number of images in the batch
+    "These {} images are consecutive pages of one document. "
+    "For each image, in order, extract all text content accurately. Preserve the original structure and formatting as much as possible in Markdown format. "
+    f"Separate the output for each image with a line containing only {PAGE_BREAK_SENTINEL}. Do not add any other commentary."
+)
+
+# Fragments written around each page's text in the output Markdown
+_PAGE_HEADER = "## Page {}\n\n".format
+_PAGE_SEPARATOR = "\n\n---\n"
 
 # --- Helper Functions ---
 
 
-def render_pdf_page_as_image_bytes(
-    pdf_bytes: bytes, page_num: int, zoom: int = 2
-) -> bytes | None:
-    """Renders a specific page of a PDF as PNG image bytes.
+def _ocr_options(num_images: int) -> dict:
+    """Returns the Ollama model options for an OCR request over `num_images` pages."""
+    return {
+        "temperature": 0.1,
+        "top_k": 20,
+        "num_predict": OCR_NUM_PREDICT_PER_PAGE * num_images,
+        "num_ctx": OCR_NUM_CTX,
+    }
+
+
+def warm_up_model(model_name: str, status_container) -> bool:
+    """Loads the model into Ollama's memory ahead of the first page.
+
+    On a cold start the first request pays the full model-load time, which
+    would otherwise count against that page's timeout.
 
     Args:
-        pdf_bytes: The content of the PDF file as bytes.
-        page_num: The page number to render (0-indexed).
-        zoom: The zoom factor for rendering (higher zoom = higher resolution).
+        model_name: The name of the Ollama model to load.
+        status_container: The Streamlit status container for progress updates.
 
     Returns:
-        The PNG image data as bytes, or None if an error occurs.
+        True if the model was loaded, False otherwise.
     """
+    status_container.write(f"⏳ Loading model '{model_name}'...")
     try:
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        if page_num >= len(doc):
-            st.error(f"Error: Page number {page_num + 1} out of range for PDF.")
-            return None
-
-        page = doc.load_page(page_num)
-        mat = fitz.Matrix(zoom, zoom)
-        pix = page.get_pixmap(matrix=mat)
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format="PNG")
-        img_byte_arr = img_byte_arr.getvalue()
-        doc.close()
-        return img_byte_arr
+        # An empty prompt just loads the model; keep_alive stops it unloading
+        ollama.Client(
+            host=OLLAMA_HOST, timeout=OLLAMA_REQUEST_TIMEOUT_SECONDS
+        ).generate(
+            model=model_name,
+            prompt="",
+            options={"num_ctx": OCR_NUM_CTX},
+            keep_alive="-1m",
+        )
+        return True
     except Exception as e:
-        st.error(f"Error rendering PDF page {page_num + 1}: {e}")
-        return None
+        status_container.warning(f"⚠️ Could not preload model '{model_name}': {e}")
+        return False
 
 
-def extract_text_from_image_bytes(
-    image_bytes: bytes, model_name: str, page_num: int, filename: str
-) -> str | None:
+async def extract_text_from_image_bytes(
+    client: ollama.AsyncClient,
+    image_bytes: bytes,
+    model_name: str,
+    page_num: int,
+    filename: str,
+) -> tuple[str | None, str | None]:
     """Extracts text from image bytes using a multimodal Ollama model.
 
+    The request is sent through the run's shared `ollama.AsyncClient` so
+    several pages can be in flight at once over kept-alive connections. Errors
+    are returned rather than shown, leaving all Streamlit output to
+    `process_pdf`.
+
     Args:
+        client: The Ollama client shared by every request in this run.
         image_bytes: The PNG image data as bytes.
         model_name: The name of the Ollama model to use (must be multimodal).
         page_num: The page number (for logging/error messages).
         filename: The original filename (for logging/error messages).
 
     Returns:
-        The extracted text as a string, or None if an error occurs.
+        A tuple containing:
+        - str | None: The extracted text, or None if an error occurs.
+        - str | None: An error message if extraction failed, else None.
     """
     try:
-        b64_image = base64.b64encode(image_bytes).decode("utf-8")
-        prompt = "Extract all text content from this image accurately. Preserve the original structure and formatting as much as possible in Markdown format."
-        messages = [{"role": "user", "content": prompt, "images": [b64_image]}]
-        response = ollama.chat(
+        messages = [{"role": "user", "content": OCR_PROMPT, "images": [image_bytes]}]
+        response = await client.chat(
             model=model_name,
             messages=messages,
-            options={"temperature": 0.1},
+            options=_ocr_options(1),
             keep_alive="-1m",
         )
-        return response["message"]["content"]
+        if response.get("done_reason") == "length":
+            return None, (
+                f"Output for Page {page_num + 1} of '{filename}' hit the "
+                f"{OCR_NUM_PREDICT_PER_PAGE}-token limit and was cut off."
+            )
+        text = response["message"]["content"]
+        if not text.strip():
+            return None, "Model returned no text"
+        return text, None
     except ollama.ResponseError as e:
-        st.error(
-            f"Ollama API Error (Page {page_num + 1}, File '{filename}'): {e.error}"
-        )
-        st.warning(
+        return None, (
+            f"Ollama API Error (Page {page_num + 1}, File '{filename}'): {e.error}. "
             f"Ensure the Ollama server is running and the model '{model_name}' is pulled and is MULTIMODAL (can process images)."
         )
-        return None
     except Exception as e:
-        st.error(
-            f"Error during text extraction (Page {page_num + 1}, File '{filename}'): {e}"
+        return (
+            None,
+            f"Error during text extraction (Page {page_num + 1}, File '{filename}'): {e}",
         )
+
+
+async def extract_text_from_image_batch(
+    client: ollama.AsyncClient,
+    images: list[bytes],
+    model_name: str,
+    page_nums: list[int],
+    filename: str,
+) -> tuple[list[tuple[str | None, str | None]], str | None]:
+    """Extracts text from several page images with a single Ollama request.
+
+    All images go into one chat message, and the model is asked to separate
+    each page's Markdown with `PAGE_BREAK_SENTINEL`. If the request is
+    rejected, the reply is cut off at the token limit, or it doesn't split into
+    one part per image, each page is retried on its own with
+    `extract_text_from_image_bytes`.
+
+    Args:
+        client: The Ollama client shared by every request in this run.
+        images: The PNG image data for each page, in page order.
+        model_name: The name of the Ollama model to use (must be multimodal).
+        page_nums: The page numbers of `images` (for logging/error messages).
+        filename: The original filename (for logging/error messages).
+
+    Returns:
+        A tuple containing:
+        - list: A `(text, error)` pair per image, as from
+          `extract_text_from_image_bytes`.
+        - str | None: A warning if the batch had to be retried page by page.
+    """
+    if len(images) == 1:
+        result = await extract_text_from_image_bytes(
+            client, images[0], model_name, page_nums[0], filename
+        )
+        return [result], None
+
+    # Cache hits and render failures can leave gaps, so list the pages
+    pages_label = "Pages " + ", ".join(str(page_num + 1) for page_num in page_nums)
+    try:
+        prompt = OCR_BATCH_PROMPT.format(len(images))
+        messages = [{"role": "user", "content": prompt, "images": images}]
+        response = await client.chat(
+            model=model_name,
+            messages=messages,
+            options=_ocr_options(len(images)),
+            keep_alive="-1m",
+        )
+        parts = [
+            part.strip()
+            for part in response["message"]["content"].split(PAGE_BREAK_SENTINEL)
+        ]
+        if len(parts) == len(images) + 1 and not parts[-1]:
+            parts.pop()  # Trailing separator after the last page
+        if response.get("done_reason") == "length":
+            warning = f"Batched response for {pages_label} of '{filename}' hit the token limit. Retrying page by page."
+        elif len(parts) == len(images):
+            return [
+                (part, None) if part else (None, "Model returned no text")
+                for part in parts
+            ], None
+        else:
+            warning = f"Batched response for {pages_label} of '{filename}' had {len(parts)} part(s) for {len(images)} page(s). Retrying page by page."
+    except ollama.ResponseError as e:
+        warning = f"Ollama API Error ({pages_label}, File '{filename}'): {e.error}. Retrying page by page."
+    except Exception as e:
+        error = f"Error during text extraction ({pages_label}, File '{filename}'): {e}"
+        return [(None, error)] * len(images), None
+
+    results = [
+        await extract_text_from_image_bytes(
+            client, image_bytes, model_name, page_num, filename
+        )
+        for image_bytes, page_num in zip(images, page_nums)
+    ]
+    return results, warning
+
+
+def _ocr_cache_path(cache_dir: Path, image_bytes: bytes, model_name: str) -> Path:
+    """Returns the cache file for a page image's text as extracted by `model_name`.
+
+    The key also covers the prompts and model options, so changing how pages
+    are OCR'd doesn't keep serving text produced the old way.
+    """
+    settings = json.dumps(
+        [model_name, OCR_PROMPT, OCR_BATCH_PROMPT, _ocr_options(1)], sort_keys=True
+    )
+    digest = hashlib.sha256(settings.encode("utf-8") + b"\0" + image_bytes)
+    return cache_dir / f"{digest.hexdigest()}.md"
+
+
+def _read_ocr_cache(cache_path: Path) -> str | None:
+    """Returns the cached text at `cache_path`, or None on a cache miss."""
+    try:
+        return cache_path.read_text(encoding="utf-8")
+    except OSError:
         return None
 
 
-def process_pdf(
-    uploaded_file, model_name: str, output_dir: str, status_container
+def _write_ocr_cache(cache_path: Path, text: str) -> None:
+    """Atomically stores `text` at `cache_path`; the cache is best-effort."""
+    try:
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=cache_path.parent, suffix=".tmp", delete=False
+        ) as f:
+            f.write(text)
+        os.replace(f.name, cache_path)
+    except OSError:
+        if "f" in locals() and os.path.exists(f.name):
+            os.remove(f.name)
+
+
+@st.cache_resource(show_spinner=False)
+def _get_render_pool() -> ProcessPoolExecutor | None:
+    """Returns the render worker pool shared by every run of the app.
+
+    PyMuPDF holds the GIL while rasterizing, so large files render in worker
+    processes. They're spawned rather than forked, since forking would copy
+    this threaded server. A spawned worker still re-runs this script as
+    `__mp_main__` (Streamlit's `__main__` points at it), importing Streamlit,
+    Ollama and PyMuPDF, so the pool is created once and kept for later runs
+    instead of per click. Workers start on first use.
+
+    Returns:
+        The pool, or None if there's only one CPU to render on.
+    """
+    num_workers = min(os.cpu_count() or 1, MAX_RENDER_WORKERS)
+    if num_workers < 2:
+        return None
+    return ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=pdf_render.init_render_worker,
+        initargs=(MAX_CONCURRENT_FILES,),
+    )
+
+
+async def process_pdf(
+    uploaded_file,
+    model_name: str,
+    output_path: str,
+    status_container,
+    client: ollama.AsyncClient,
+    ocr_semaphore: asyncio.Semaphore,
+    render_pool: Executor | None,
+    use_cache: bool = True,
 ) -> tuple[bool, str | None]:
     """Processes a single uploaded PDF file for OCR.
 
     Args:
         uploaded_file: The Streamlit UploadedFile object.
         model_name: The Ollama model name.
-        output_dir: The directory to save the output Markdown file.
+        output_path: Where to save the output Markdown file, in an existing
+            directory. Must differ from every other file processed at the same time.
         status_container: The Streamlit status container for progress updates.
+        client: The Ollama client shared by every file in this run.
+        ocr_semaphore: Bounds in-flight Ollama requests across all files being
+            processed, so concurrent files share the server's parallel slots.
+        render_pool: The render worker processes from `_get_render_pool` (see
+            `pdf_render.render_page_from_file`), or None to render in-process.
+        use_cache: Whether to reuse and store page text in the `.cache` directory
+            next to `output_path` (created by `process_pdfs`), keyed as in
+            `_ocr_cache_path`.
 
     Returns:
         A tuple containing:
@@ -108,15 +319,16 @@ def process_pdf(
     filename = uploaded_file.name
     status_container.write(f"📄 Starting processing for: **{filename}**")
     start_time_file = time.time()
-    output_path = None  # Initialize output path
     processing_successful = True  # Assume success unless a critical error occurs
     partial_success = False  # Flag if some pages failed but others succeeded
+    doc = None  # Kept open for the whole file; closed in `finally`
+    part_path = None  # Removed in `finally` unless it became the output
+    pdf_path = None  # Copy of the PDF for the render workers; removed in `finally`
 
     try:
         pdf_bytes = uploaded_file.getvalue()
         doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        num_pages = len(doc)
-        doc.close()
+        num_pages = doc.page_count
 
         if num_pages == 0:
             status_container.warning(f"⚠️ Skipping '{filename}': No pages found.")
@@ -124,77 +336,201 @@ def process_pdf(
 
         status_container.write(f"Total pages found: {num_pages}")
 
-        all_pages_text = []
-        page_progress = st.progress(0.0, text=f"Page 1/{num_pages}")
-
-        for i in range(num_pages):
-            page_num = i + 1
-            status_container.write(f"    - Rendering Page {page_num}...")
-            start_time_page = time.time()
-
-            image_bytes = render_pdf_page_as_image_bytes(pdf_bytes, i)
-
-            if image_bytes:
-                status_container.write(
-                    f"    - Extracting text from Page {page_num} using '{model_name}'..."
-                )
-                extracted_text = extract_text_from_image_bytes(
-                    image_bytes, model_name, i, filename
+        cache_dir = Path(output_path).parent / ".cache"
+        header = f"# OCR Output for: {filename}\n\n"
+        pending_pages: dict[int, str] = {}
+        next_page_to_write = 0
+        pages_written = 0
+        page_progress = st.progress(0.0, text=f"Page 0/{num_pages}")
+        pages_done = 0
+        pages_drawn = 0  # pages_done as of the last progress bar redraw
+        progress_step = max(1, num_pages // 50)  # At most ~50 redraws per file
+        timed_out = False
+        batch_tasks: list[asyncio.Task] = []  # Cancelled together on a timeout
+
+        def _write_page(i: int, page_text: str) -> None:
+            nonlocal next_page_to_write, pages_written
+            pending_pages[i] = page_text
+            while next_page_to_write in pending_pages:
+                # Written in pieces so no per-page "## Page" string is built
+                part_file.write(_PAGE_HEADER(next_page_to_write + 1))
+                part_file.write(pending_pages.pop(next_page_to_write))
+                part_file.write(_PAGE_SEPARATOR)
+                next_page_to_write += 1
+                pages_written += 1
+            part_file.flush()
+
+        async def _page_batch(
+            indices: list[int],
+            sem: asyncio.Semaphore,
+            executor: Executor,
+            render: Callable[[int, int], tuple[bytes | None, str | None]],
+        ) -> None:
+            nonlocal pages_done, pages_drawn, partial_success, timed_out
+            async with sem:
+                if timed_out:
+                    return  # A previous batch timed out; stop processing this file
+
+                for i in indices:
+                    status_container.write(f"    - Rendering Page {i + 1}...")
+                loop = asyncio.get_running_loop()
+                rendered = await asyncio.gather(
+                    *(
+                        loop.run_in_executor(executor, render, i, OCR_MAX_DIM)
+                        for i in indices
+                    )
                 )
 
-                if extracted_text:
-                    all_pages_text.append(
-                        f"## Page {page_num}\n\n{extracted_text}\n\n---\n"
-                    )
+                page_texts: dict[int, str] = {}
+                ocr_indices: list[int] = []
+                images: list[bytes] = []
+                cache_paths: list[Path | None] = []
+                for i, (image_bytes, render_error) in zip(indices, rendered):
+                    if image_bytes:
+                        cache_path = None
+                        if use_cache:
+                            cache_path = _ocr_cache_path(
+                                cache_dir, image_bytes, model_name
+                            )
+                            cached_text = _read_ocr_cache(cache_path)
+                            if cached_text is not None:
+                                page_texts[i] = cached_text
+                                status_container.write(
+                                    f"    ✅ Text for Page {i + 1} loaded from cache."
+                                )
+                                continue
+                        ocr_indices.append(i)
+                        images.append(image_bytes)
+                        cache_paths.append(cache_path)
+                    else:
+                        status_container.warning(
+                            f"    ⚠️ Failed to render Page {i + 1} ({render_error}). Skipping page content."
+                        )
+                        page_texts[i] = "[Page rendering failed]"
+                        partial_success = True  # Mark as partial success
+
+                if images:
+                    pages_label = ", ".join(str(i + 1) for i in ocr_indices)
                     status_container.write(
-                        f"    ✅ Text extracted for Page {page_num}."
-                    )
-                else:
-                    status_container.warning(
-                        f"    ⚠️ Failed to extract text for Page {page_num}. Skipping page content."
-                    )
-                    all_pages_text.append(
-                        f"## Page {page_num}\n\n[Text extraction failed for this page]\n\n---\n"
-                    )
-                    partial_success = True  # Mark as partial success
-
-                elapsed_time_page = time.time() - start_time_page
-                if elapsed_time_page > MAX_PROCESSING_TIME_PER_PAGE_SECONDS:
-                    status_container.error(
-                        f"    ❌ Timeout processing Page {page_num} after {elapsed_time_page:.1f}s. Stopping processing for this file."
+                        f"    - Extracting text from Page(s) {pages_label} using '{model_name}'..."
                     )
-                    processing_successful = False  # Mark as failed due to timeout
-                    break  # Stop processing this file
-            else:
-                status_container.warning(
-                    f"    ⚠️ Failed to render Page {page_num}. Skipping page content."
-                )
-                all_pages_text.append(
-                    f"## Page {page_num}\n\n[Page rendering failed]\n\n---\n"
+                    timeout = MAX_PROCESSING_TIME_PER_PAGE_SECONDS * len(images)
+                    try:
+                        results, batch_warning = await asyncio.wait_for(
+                            extract_text_from_image_batch(
+                                client, images, model_name, ocr_indices, filename
+                            ),
+                            timeout=timeout,
+                        )
+                    except asyncio.TimeoutError:
+                        status_container.error(
+                            f"    ❌ Timeout processing Page(s) {pages_label} after {timeout}s. Stopping processing for this file."
+                        )
+                        timed_out = True  # Mark as failed due to timeout
+                        # Free the shared OCR slots held by this file's other batches
+                        for task in batch_tasks:
+                            if task is not asyncio.current_task():
+                                task.cancel()
+                        return
+
+                    if batch_warning:
+                        status_container.warning(f"    ⚠️ {batch_warning}")
+                    for i, (extracted_text, ocr_error), cache_path in zip(
+                        ocr_indices, results, cache_paths
+                    ):
+                        page_num = i + 1
+                        if extracted_text:
+                            # Cut-off replies arrive as errors, so they never reach the cache
+                            if cache_path is not None:
+                                _write_ocr_cache(cache_path, extracted_text)
+                            page_texts[i] = extracted_text
+                            status_container.write(
+                                f"    ✅ Text extracted for Page {page_num}."
+                            )
+                        else:
+                            status_container.warning(
+                                f"    ⚠️ Failed to extract text for Page {page_num} ({ocr_error}). Skipping page content."
+                            )
+                            page_texts[i] = "[Text extraction failed for this page]"
+                            partial_success = True  # Mark as partial success
+
+                for i in indices:
+                    _write_page(i, page_texts[i])
+
+            pages_done += len(indices)
+            if pages_done - pages_drawn >= progress_step or pages_done == num_pages:
+                pages_drawn = pages_done
+                progress_percentage = min(1.0, pages_done / num_pages)
+                page_progress.progress(
+                    progress_percentage, text=f"Page {pages_done}/{num_pages}"
                 )
-                partial_success = True  # Mark as partial success
 
-            progress_percentage = min(1.0, page_num / num_pages)
-            page_progress.progress(
-                progress_percentage, text=f"Page {page_num}/{num_pages}"
+        async def _run_all(
+            executor: Executor,
+            render: Callable[[int, int], tuple[bytes | None, str | None]],
+        ) -> None:
+            batches = [
+                list(range(start, min(start + OCR_PAGES_PER_REQUEST, num_pages)))
+                for start in range(0, num_pages, OCR_PAGES_PER_REQUEST)
+            ]
+            batch_tasks.extend(
+                asyncio.create_task(_page_batch(batch, ocr_semaphore, executor, render))
+                for batch in batches
             )
-            time.sleep(0.1)
+            # Batches cancelled after a timeout come back as CancelledError;
+            # anything else is re-raised, including Streamlit's rerun and stop
+            # requests, which are BaseExceptions raised from status writes
+            for result in await asyncio.gather(*batch_tasks, return_exceptions=True):
+                if isinstance(result, BaseException) and not isinstance(
+                    result, asyncio.CancelledError
+                ):
+                    raise result
+
+        # Pages are streamed to a ".part" file as they finish, so only pages that
+        # completed ahead of an earlier, still-running page are held in memory.
+        # Its name is unique, so runs writing the same output can't collide
+        # (unlike mkstemp, "x" mode keeps the usual permissions for the output)
+        part_path = f"{output_path}.{uuid.uuid4().hex}.part"
+        with open(part_path, "x", encoding="utf-8") as part_file:
+            part_file.write(header)
+            if render_pool is not None and num_pages >= RENDER_POOL_MIN_PAGES:
+                # Workers open the PDF once from this copy, so only its path and
+                # a page number are sent per task. The path is also the workers'
+                # cache key, so it's never reused while the pool lives
+                pdf_path = os.path.join(
+                    tempfile.gettempdir(), f"pdf-ocr-{uuid.uuid4().hex}.pdf"
+                )
+                with open(pdf_path, "xb") as f:
+                    f.write(pdf_bytes)
+                await _run_all(
+                    render_pool, partial(pdf_render.render_page_from_file, pdf_path)
+                )
+            else:
+                # Render from the already-open document on one thread instead
+                # (fitz docs aren't thread-safe)
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    await _run_all(executor, partial(pdf_render.render_page, doc))
+        if timed_out:
+            processing_successful = False
 
         page_progress.empty()  # Remove progress bar for this file
 
         # --- File Saving ---
-        if processing_successful and all_pages_text:
-            output_filename = Path(output_dir) / f"{Path(filename).stem}.md"
-            os.makedirs(output_dir, exist_ok=True)
-            output_path = str(output_filename)
-
-            with open(output_filename, "w", encoding="utf-8") as f:
-                f.write(f"# OCR Output for: {filename}\n\n")
-                if partial_success:
+        if processing_successful and pages_written:
+            if partial_success:
+                # Insert the note under the title, copying the pages across in chunks
+                with (
+                    open(part_path, encoding="utf-8") as src,
+                    open(output_path, "w", encoding="utf-8") as f,
+                ):
+                    f.write(src.read(len(header)))
                     f.write(
                         "**Note:** Text extraction or page rendering failed for one or more pages. The output may be incomplete.\n\n---\n\n"
                     )
-                f.write("".join(all_pages_text))
+                    shutil.copyfileobj(src, f)
+                os.remove(part_path)
+            else:
+                os.replace(part_path, output_path)
 
             end_time_file = time.time()
             total_time_file = end_time_file - start_time_file
@@ -203,7 +539,9 @@ def process_pdf(
                 f"✅ Successfully {status_message}processed '{filename}' in {total_time_file:.2f} seconds."
             )
             return True, output_path  # Return True if any output was generated
-        elif not processing_successful:
+
+        os.remove(part_path)  # Nothing worth keeping
+        if not processing_successful:
             status_container.error(
                 f"❌ Failed to process '{filename}' due to critical error (e.g., timeout)."
             )
@@ -214,101 +552,196 @@ def process_pdf(
 
     except Exception as e:
         status_container.error(f"❌ Critical error processing '{filename}': {e}")
+        if isinstance(e, BrokenProcessPool):
+            _get_render_pool.clear()  # Start fresh workers on the next run
         if "page_progress" in locals():
             page_progress.empty()
         return False, None
+    finally:
+        for path in (part_path, pdf_path):
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+        if doc is not None:
+            doc.close()
+
+
+async def process_pdfs(
+    uploaded_files,
+    model_name: str,
+    output_dir: str,
+    status_container,
+    use_cache: bool = True,
+) -> list[tuple[bool, str | None]]:
+    """Processes several uploaded PDF files concurrently.
+
+    Up to `MAX_CONCURRENT_FILES` files run at once, so one file's rendering
+    overlaps with another's Ollama requests. All files share one semaphore of
+    `OLLAMA_NUM_PARALLEL` slots for OCR requests and one `ollama.AsyncClient`
+    whose connections are kept alive between pages and closed at the end.
+    Large files also share the render workers from `_get_render_pool`.
 
+    Args:
+        uploaded_files: The Streamlit UploadedFile objects.
+        model_name: The Ollama model name.
+        output_dir: The directory to save the output Markdown files.
+        status_container: The Streamlit status container shared by all files.
+        use_cache: Whether to reuse and store page text in the OCR cache.
 
-# --- Streamlit UI ---
+    Returns:
+        The `process_pdf` result for each file, in the order given.
+    """
+    if use_cache:
+        os.makedirs(os.path.join(output_dir, ".cache"), exist_ok=True)
+
+    # Files sharing a stem (e.g. the same PDF uploaded twice) would otherwise
+    # write the same output, so later ones get a numbered name
+    output_paths: list[str] = []
+    used_names: set[str] = set()
+    for uploaded_file in uploaded_files:
+        stem = Path(uploaded_file.name).stem
+        name, n = stem, 1
+        while name in used_names:
+            n += 1
+            name = f"{stem}_{n}"
+        used_names.add(name)
+        output_paths.append(os.path.join(output_dir, name + ".md"))
+    file_semaphore = asyncio.Semaphore(MAX_CONCURRENT_FILES)
+    ocr_semaphore = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+
+    async def _bounded(i: int, uploaded_file) -> tuple[bool, str | None]:
+        async with file_semaphore:
+            status_container.update(
+                label=f"Processing file {i+1}/{len(uploaded_files)}: **{uploaded_file.name}**"
+            )
+            return await process_pdf(
+                uploaded_file,
+                model_name,
+                output_paths[i],
+                status_container,
+                client,
+                ocr_semaphore,
+                render_pool,
+                use_cache,
+            )
 
-st.set_page_config(layout="wide")
-st.title("📄 PDF OCR with Local Ollama Model")
-st.markdown(
-    f"""
-Upload PDF files below. The app uses the local Ollama model **`{OLLAMA_MODEL}`** to extract text.
-Click 'Start OCR Processing' once your files are uploaded.
+    render_pool = _get_render_pool()
+    client = ollama.AsyncClient(
+        host=OLLAMA_HOST, timeout=OLLAMA_REQUEST_TIMEOUT_SECONDS
+    )
+    try:
+        return await asyncio.gather(
+            *(_bounded(i, f) for i, f in enumerate(uploaded_files))
+        )
+    finally:
+        await client.close()
 
-**Important:** This app requires a **multimodal** Ollama model (like `llava`) capable of processing images.
-If `{OLLAMA_MODEL}` is text-only, text extraction will fail. Ensure the correct model is running in Ollama.
-"""
-)
 
-# --- File Uploader ---
-# This widget now handles displaying the list of files and allows removal via 'x'
-uploaded_files = st.file_uploader(
-    "Choose PDF files", type="pdf", accept_multiple_files=True, key="file_uploader"
-)
+# --- Streamlit UI ---
 
 
-# --- Processing Button and Logic ---
-st.divider()
-start_processing = st.button(
-    "🚀 Start OCR Processing",
-    # Disable button if no files are currently listed in the uploader
-    disabled=not uploaded_files,
-    type="primary",
-)
+def main() -> None:
+    """Renders the app. Run with `streamlit run app.py`."""
+    st.set_page_config(layout="wide")
+    st.title("📄 PDF OCR with Local Ollama Model")
+    st.markdown(
+        f"""
+    Upload PDF files below. The app uses the local Ollama model **`{OLLAMA_MODEL}`** to extract text.
+    Click 'Start OCR Processing' once your files are uploaded.
+
+    **Important:** This app requires a **multimodal** Ollama model (like `llava`) capable of processing images.
+    If `{OLLAMA_MODEL}` is text-only, text extraction will fail. Ensure the correct model is running in Ollama.
+
+    **Concurrency:** Pages are sent in groups of up to **{OCR_PAGES_PER_REQUEST}**, with up to **{OLLAMA_NUM_PARALLEL}** requests to Ollama at once. Set the `OLLAMA_NUM_PARALLEL`
+    environment variable to the same value for both the Ollama server and this app.
+    """
+    )
+
+    use_ocr_cache = st.sidebar.checkbox(
+        "Use OCR cache",
+        value=True,
+        help=f"Reuse text for pages already extracted with this model and prompt (stored in `{OUTPUT_DIR}/.cache`). Turn off to re-run OCR on every page.",
+    )
+
+    # --- File Uploader ---
+    # This widget now handles displaying the list of files and allows removal via 'x'
+    uploaded_files = st.file_uploader(
+        "Choose PDF files", type="pdf", accept_multiple_files=True, key="file_uploader"
+    )
+
+    # --- Processing Button and Logic ---
+    st.divider()
+    start_processing = st.button(
+        "🚀 Start OCR Processing",
+        # Disable button if no files are currently listed in the uploader
+        disabled=not uploaded_files,
+        type="primary",
+    )
+
+    if start_processing and uploaded_files:
+        st.subheader("⚙️ Processing Files...")
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        results_summary = []
+        overall_start_time = time.time()
+
+        # Use the list of files directly from the uploader
+        files_to_process = uploaded_files
+
+        with st.status(
+            f"Starting OCR for {len(files_to_process)} file(s)...", expanded=True
+        ) as status:
+            # Load the model once per session so it isn't timed as part of a page
+            if not st.session_state.get("warmed"):
+                st.session_state["warmed"] = warm_up_model(OLLAMA_MODEL, status)
 
-if start_processing and uploaded_files:
-    st.subheader("⚙️ Processing Files...")
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-    results_summary = []
-    overall_start_time = time.time()
-
-    # Use the list of files directly from the uploader
-    files_to_process = uploaded_files
-
-    with st.status(
-        f"Starting OCR for {len(files_to_process)} file(s)...", expanded=True
-    ) as status:
-        for i, uploaded_file in enumerate(files_to_process):
-            # Create a temporary container within the status for this file's logs
-            # file_status_container = st.container() # Use container if needed for more structure
-            status.update(
-                label=f"Processing file {i+1}/{len(files_to_process)}: **{uploaded_file.name}**"
-            )
             # Pass the main status object for updates
-            success, output_path = process_pdf(
-                uploaded_file, OLLAMA_MODEL, OUTPUT_DIR, status
-            )
-            results_summary.append(
-                {
-                    "filename": uploaded_file.name,
-                    "success": success,
-                    "output_path": output_path,
-                }
+            results = asyncio.run(
+                process_pdfs(
+                    files_to_process, OLLAMA_MODEL, OUTPUT_DIR, status, use_ocr_cache
+                )
             )
-            time.sleep(0.5)  # Small delay between files
-
-        overall_end_time = time.time()
-        total_processing_time = overall_end_time - overall_start_time
-        status.update(
-            label=f"✅ Processing Complete! ({total_processing_time:.2f}s)",
-            state="complete",
-            expanded=False,
-        )
+            for uploaded_file, (success, output_path) in zip(files_to_process, results):
+                results_summary.append(
+                    {
+                        "filename": uploaded_file.name,
+                        "success": success,
+                        "output_path": output_path,
+                    }
+                )
 
-    # --- Display Summary ---
-    st.subheader("📊 Processing Summary")
-    successful_files = [r for r in results_summary if r["success"]]
-    failed_files = [r for r in results_summary if not r["success"]]
-
-    if successful_files:
-        st.success(f"**Successfully processed {len(successful_files)} file(s):**")
-        for result in successful_files:
-            # Added icon and clearer path indication
-            st.markdown(
-                f"✔️ **{result['filename']}** → Output saved to `{result['output_path']}`"
-            )
-    else:
-        st.info("No files were processed successfully.")
-
-    if failed_files:
-        st.error(f"**Failed or could not process {len(failed_files)} file(s):**")
-        for result in failed_files:
-            # Added icon
-            st.markdown(
-                f"❌ **{result['filename']}** (Check logs in the collapsed 'Processing Complete' section above for details)"
+            overall_end_time = time.time()
+            total_processing_time = overall_end_time - overall_start_time
+            status.update(
+                label=f"✅ Processing Complete! ({total_processing_time:.2f}s)",
+                state="complete",
+                expanded=False,
             )
 
-    st.info(f"Total processing time: {total_processing_time:.2f} seconds.")
+        # --- Display Summary ---
+        st.subheader("📊 Processing Summary")
+        successful_files = [r for r in results_summary if r["success"]]
+        failed_files = [r for r in results_summary if not r["success"]]
+
+        if successful_files:
+            st.success(f"**Successfully processed {len(successful_files)} file(s):**")
+            for result in successful_files:
+                # Added icon and clearer path indication
+                st.markdown(
+                    f"✔️ **{result['filename']}** → Output saved to `{result['output_path']}`"
+                )
+        else:
+            st.info("No files were processed successfully.")
+
+        if failed_files:
+            st.error(f"**Failed or could not process {len(failed_files)} file(s):**")
+            for result in failed_files:
+                # Added icon
+                st.markdown(
+                    f"❌ **{result['filename']}** (Check logs in the collapsed 'Processing Complete' section above for details)"
+                )
+
+        st.info(f"Total processing time: {total_processing_time:.2f} seconds.")
+
+
+# Spawned render workers run this file as "__mp_main__"; keep the UI out of them
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""PDF page rendering, kept in its own module for the render worker processes.
+
+Tasks refer to these functions by module name, so each worker needs only
+PyMuPDF to run them. Spawned workers still re-run `app.py` as `__mp_main__`,
+and the script's `__name__` guard keeps the UI out of them.
+"""
+
+from collections import OrderedDict
+
+import fitz  # PyMuPDF
+
+# PDFs already opened by this worker, least recently used first. Set up by
+# `init_render_worker`.
+_open_docs: OrderedDict[str, fitz.Document] = OrderedDict()
+_max_open_docs = 1
+
+
+def render_page(
+    doc: fitz.Document, page_num: int, ocr_max_dim: int
+) -> tuple[bytes | None, str | None]:
+    """Renders a specific page of an open PDF document as PNG image bytes.
+
+    Must not call into Streamlit, since it runs inside `ProcessPoolExecutor`
+    workers (see `render_page_from_file`).
+
+    Args:
+        doc: The already-open PyMuPDF document.
+        page_num: The page number to render (0-indexed).
+        ocr_max_dim: The length in pixels of the page's longest side. Small
+            pages are scaled up to it so text stays legible, and large ones
+            down, since the model downscales bigger images anyway and rendering
+            them only adds payload and prefill work.
+
+    Returns:
+        A tuple containing:
+        - bytes | None: The PNG image data, or None if an error occurs.
+        - str | None: An error message if rendering failed, else None.
+    """
+    try:
+        if page_num >= len(doc):
+            return None, f"Error: Page number {page_num + 1} out of range for PDF."
+
+        page = doc.load_page(page_num)
+        rect = page.rect
+        zoom = ocr_max_dim / max(rect.width, rect.height)
+        mat = fitz.Matrix(zoom, zoom)
+        # Plain 3-byte RGB, so no alpha channel is allocated or encoded
+        pix = page.get_pixmap(matrix=mat, colorspace=fitz.csRGB, alpha=False)
+        # MuPDF's native PNG encoder; avoids copying the pixels into PIL
+        return pix.tobytes(output="png"), None
+    except Exception as e:
+        return None, f"Error rendering PDF page {page_num + 1}: {e}"
+
+
+def init_render_worker(max_open_docs: int) -> None:
+    """Sets how many PDFs a render worker keeps open at once.
+
+    Args:
+        max_open_docs: The number of files that may be rendering at the same
+            time. Each one stays open so its pages don't re-parse the PDF.
+    """
+    global _max_open_docs
+    _max_open_docs = max(1, max_open_docs)
+
+
+def render_page_from_file(
+    pdf_path: str, page_num: int, ocr_max_dim: int
+) -> tuple[bytes | None, str | None]:
+    """Renders a page of the PDF at `pdf_path` in a render worker.
+
+    The PDF is opened on first use and kept open for later pages. Once more
+    than `max_open_docs` PDFs are open, the least recently used one is closed.
+
+    Args:
+        pdf_path: A PDF file. Also the cache key, so it must not be reused
+            for a different PDF while the pool is running.
+        page_num: The page number to render (0-indexed).
+        ocr_max_dim: See `render_page`.
+
+    Returns:
+        The same `(image_bytes, error)` pair as `render_page`.
+    """
+    doc = _open_docs.get(pdf_path)
+    if doc is None:
+        try:
+            # Read into memory so the file isn't held open (and can be deleted)
+            with open(pdf_path, "rb") as f:
+                doc = fitz.open(stream=f.read(), filetype="pdf")
+        except Exception as e:
+            return None, f"Error opening PDF for page {page_num + 1}: {e}"
+        _open_docs[pdf_path] = doc
+        while len(_open_docs) > _max_open_docs:
+            _open_docs.popitem(last=False)[1].close()
+    else:
+        _open_docs.move_to_end(pdf_path)
+    return render_page(doc, page_num, ocr_max_dim)